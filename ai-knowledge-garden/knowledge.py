@@ -1,18 +1,642 @@
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, Response, request, jsonify, session, g
 import json
+import hashlib
 import re
 from datetime import datetime
 import os
-import tempfile
+import unicodedata
+import bisect
+import heapq
+import math
+import threading
+import time
+import uuid
+from collections import Counter, OrderedDict
 
 knowledge_bp = Blueprint('knowledge', __name__)
 
-# グローバル変数でデータを保存（本番環境では適切なデータベースを使用）
-chat_data = {
-    'messages': [],
-    'conversations': [],
-    'stats': {'messages': 0, 'conversations': 0, 'searches': 0}
-}
+def new_garden():
+    """空のガーデン（ユーザーごとのデータ保存領域）を作成"""
+    return {
+        'messages': [],
+        'conversations': [],
+        'stats': {'messages': 0, 'conversations': 0, 'searches': 0},
+        'index': None,
+        'tombstones': set(),   # 削除済みメッセージの位置（圧縮時に回収）
+        'generation': 0,       # データ変更のたびに増加（圧縮中の変更検出用）
+        'compacting': False,
+        'size': 0,             # 推定メモリ使用量（バイト）
+        'active': 0,           # 処理中のリクエスト数
+        'upload_hashes': {},   # ファイル内容のハッシュ -> バッチID（重複アップロード防止）
+        'pending_uploads': set(),  # 処理中のアップロードのハッシュ
+        # データ変更時と、変更中のインデックスを参照する読み取り時のロック（ガーデンごと）
+        'lock': threading.RLock()
+    }
+
+# ユーザーごとのガーデンをメモリに保持（最近使われた順）
+# 本番環境では適切なデータベースを使用
+gardens = OrderedDict()
+evicting_gardens = {}
+loading_gardens = {}   # スナップショット読み込み中のキー -> 完了通知
+gardens_lock = threading.Lock()
+
+# ガーデンの設定
+GARDEN_MEMORY_BUDGET = int(os.environ.get('GARDEN_MEMORY_BUDGET_MB', 512)) * 1024 * 1024
+GARDEN_SNAPSHOT_DIR = os.environ.get(
+    'GARDEN_SNAPSHOT_DIR',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'garden_snapshots')
+)
+# 推測されにくいよう十分な長さを要求（セッションで発行するキーはUUIDの16進32文字）
+GARDEN_KEY_PATTERN = re.compile(r'^[A-Za-z0-9_-]{32,64}$')
+GARDEN_BYTES_PER_CHAR = 8         # 本文1文字あたりの推定メモリ（インデックス込み）
+GARDEN_BYTES_PER_MESSAGE = 1024   # メッセージ1件あたりの推定メモリ（辞書などの固定分）
+
+# アップロード進捗（(ガーデンのキー, アップロードID) -> 進捗）
+upload_progress = {}
+UPLOAD_ID_PATTERN = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+PROGRESS_INTERVAL = 200             # 何件ごとに進捗を更新するか
+PROGRESS_POLL_SECONDS = 0.2         # SSEで進捗を確認する間隔
+PROGRESS_WAIT_SECONDS = 30          # アップロード開始を待つ最大時間
+PROGRESS_RETENTION_SECONDS = 300    # 完了した進捗を保持する時間
+PROGRESS_FINAL_STATES = ('done', 'error', 'duplicate')
+
+# 検索インデックスの設定
+FUZZY_MAX_EXPANSIONS = 5      # 1つのクエリ語に対して展開する候補語の最大数
+FUZZY_CANDIDATE_LIMIT = 50    # 編集距離を計算する候補語の上限（計算量の上限）
+FUZZY_MIN_TERM_LENGTH = 3     # これより短い語は編集距離による展開の対象外
+FUZZY_PREFIX_LIMIT = 50       # 前方一致で展開する語の上限（出現メッセージ数の多い順）
+FUZZY_TRIGRAM_SCAN_LIMIT = 5000  # 候補探しでトライグラムからたどる語の総数の上限
+SIMILAR_QUERY_TERMS = 24      # 類似度計算に使う重みの大きい語の数
+SIMILAR_MAX_DF_RATIO = 0.1    # これより多くの会話に出現する語は類似度計算で無視
+SIMILAR_MIN_DF_CUTOFF = 100   # 会話数が少ないうちは出現頻度による除外を行わない
+SUGGEST_DEFAULT_LIMIT = 10    # 補完候補の既定の返却件数
+SUGGEST_CACHE_SIZE = 1024     # 接頭辞ごとの補完結果をキャッシュする上限
+COMPACTION_RATIO = 0.2        # 削除済みメッセージがこの割合を超えたら圧縮
+COMPACTION_MAX_TOMBSTONES = 10000  # 割合に関係なく圧縮する削除済みメッセージ数
+COMPACTION_MAX_ATTEMPTS = 3   # 圧縮中にデータが変更された場合の再試行回数
+SIMILAR_DEFAULT_LIMIT = 10    # 類似会話の既定の返却件数
+
+# 文字種（漢字・ひらがな・カタカナ・英数字）ごとに分割してトークン化する
+TOKEN_PATTERN = re.compile(
+    r'[\u3400-\u4dbf\u4e00-\u9fff々〆]+'
+    r'|[\u3041-\u309f]+'
+    r'|[\u30a1-\u30ffー]+'
+    r'|[^\W_\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff]+'
+)
+
+def new_search_index():
+    """空の検索インデックスを作成"""
+    return {
+        'postings': {},        # 語 -> メッセージ位置の集合
+        'trigrams': {},        # トライグラム -> 語の集合
+        'conv_terms': {},      # 会話ID -> 語の出現回数
+        'conv_postings': {},   # 語 -> {会話ID: 出現回数の重み}
+        'conv_norms': {},      # 会話ID -> TF-IDFベクトルのノルム
+        'norms_dirty': False,  # IDFが変わりノルムの再計算が必要か
+        'conversations': {},   # 会話ID -> 会話情報
+        'conv_messages': {},   # 会話ID -> メッセージ位置の一覧
+        'sorted_terms': None,  # 辞書順に並べた語の一覧（補完用、必要時に再構築）
+        'suggest_cache': {}    # (接頭辞, 件数) -> 補完結果
+    }
+
+def tokenize(text):
+    """テキストを正規化して語に分割"""
+    return TOKEN_PATTERN.findall(unicodedata.normalize('NFKC', text).lower())
+
+def term_trigrams(term):
+    """語の前後に境界記号を付けたトライグラムの集合を取得"""
+    padded = f"${term}$"
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+def index_messages(garden, start=0, progress=None):
+    """start以降のメッセージをインデックスに追加"""
+    if garden['index'] is None:
+        garden['index'] = new_search_index()
+        start = 0
+    postings = garden['index']['postings']
+    trigrams = garden['index']['trigrams']
+    conv_terms = garden['index']['conv_terms']
+    conv_postings = garden['index']['conv_postings']
+    conv_messages = garden['index']['conv_messages']
+    
+    # 出現頻度が変わるため補完結果のキャッシュは破棄する
+    if start < len(garden['messages']):
+        garden['index']['suggest_cache'] = {}
+    
+    for position in range(start, len(garden['messages'])):
+        message = garden['messages'][position]
+        term_counts = Counter(tokenize(message['content']))
+        conv_counts = conv_terms.setdefault(message['conversation_id'], Counter())
+        conv_counts.update(term_counts)
+        conv_messages.setdefault(message['conversation_id'], []).append(position)
+        for term, count in term_counts.items():
+            if term not in postings:
+                postings[term] = set()
+                conv_postings.setdefault(term, {})
+                garden['index']['sorted_terms'] = None
+                for gram in term_trigrams(term):
+                    trigrams.setdefault(gram, set()).add(term)
+            postings[term].add(position)
+            conv_postings[term][message['conversation_id']] = term_weight(conv_counts[term])
+        
+        if progress and (position - start + 1) % PROGRESS_INTERVAL == 0:
+            progress(indexed=position - start + 1)
+
+def index_conversations(garden, conversations):
+    """会話情報を登録
+    
+    会話が増えると全会話のIDFが変わるため、ノルムは取り込み時には計算せず、
+    次の類似検索でまとめて計算し直す（取り込みのコストは追加分の量に比例する）。
+    """
+    if garden['index'] is None:
+        garden['index'] = new_search_index()
+    index = garden['index']
+    for conv in conversations:
+        index['conversations'][conv['id']] = conv
+    index['norms_dirty'] = True
+
+def refresh_norms(index):
+    """現在のIDFで全会話のTF-IDFベクトルのノルムを計算し直す"""
+    idf = {term: term_idf(index, term) for term in index['conv_postings']}
+    index['conv_norms'] = {
+        conv_id: conversation_norm(index, counts, idf)
+        for conv_id, counts in index['conv_terms'].items()
+    }
+    index['norms_dirty'] = False
+
+def conversation_norm(index, counts, idf=None):
+    """会話のTF-IDFベクトルのノルムを計算"""
+    return math.sqrt(sum(
+        (term_weight(count) * (idf[term] if idf else term_idf(index, term))) ** 2
+        for term, count in counts.items()
+    ))
+
+def garden_snapshot(garden):
+    """メッセージ・インデックス・削除済み位置を一貫した組で取得
+    
+    圧縮はこの3つを差し替えるため、読み取り側は個別に参照せずこの組を使う。
+    """
+    with garden['lock']:
+        return garden['messages'], garden['index'] or new_search_index(), garden['tombstones']
+
+def live_messages(garden):
+    """削除済みを除いたメッセージを位置とともに取得"""
+    messages, _, tombstones = garden_snapshot(garden)
+    for position, message in enumerate(messages):
+        if position not in tombstones:
+            yield position, message
+
+def unindex_messages(index, messages, positions):
+    """削除したメッセージの位置をポスティングリストから取り除く"""
+    for position in positions:
+        for term in set(tokenize(messages[position]['content'])):
+            term_positions = index['postings'].get(term)
+            if term_positions is None:
+                continue
+            term_positions.discard(position)
+            if term_positions:
+                continue
+            
+            # どのメッセージにも残っていない語は語彙から外す
+            del index['postings'][term]
+            if not index['conv_postings'].get(term):
+                index['conv_postings'].pop(term, None)
+            for gram in term_trigrams(term):
+                terms = index['trigrams'].get(gram)
+                if terms is not None:
+                    terms.discard(term)
+                    if not terms:
+                        del index['trigrams'][gram]
+            index['sorted_terms'] = None
+
+def delete_conversations(garden, conv_ids, batch_id=None):
+    """会話を削除（メッセージは削除済みとして記録し、圧縮時に回収）
+    
+    batch_idを指定した場合は、そのアップロードで追加された分だけを削除する。
+    """
+    conv_ids = set(conv_ids)
+    deleted_messages = 0
+    with garden['lock']:
+        index = garden['index'] or new_search_index()
+        tombstones_before = set(garden['tombstones'])
+        remaining = [
+            conv for conv in garden['conversations']
+            if conv['id'] not in conv_ids or (batch_id is not None and conv.get('batch_id') != batch_id)
+        ]
+        
+        for conv_id in conv_ids:
+            positions = index['conv_messages'].pop(conv_id, [])
+            kept = [
+                position for position in positions
+                if batch_id is not None and garden['messages'][position].get('batch_id') != batch_id
+            ]
+            removed = set(positions) - set(kept)
+            garden['tombstones'].update(removed)
+            deleted_messages += len(removed)
+            
+            # 類似検索の対象からはすぐに外す
+            for term in index['conv_terms'].pop(conv_id, {}):
+                index['conv_postings'][term].pop(conv_id, None)
+            index['conv_norms'].pop(conv_id, None)
+            index['conversations'].pop(conv_id, None)
+            
+            # 同じIDの会話が別のアップロードに残っている場合はベクトルを作り直す
+            if kept:
+                counts = Counter()
+                for position in kept:
+                    counts.update(tokenize(garden['messages'][position]['content']))
+                for term, count in counts.items():
+                    index['conv_postings'][term][conv_id] = term_weight(count)
+                index['conv_terms'][conv_id] = counts
+                index['conv_messages'][conv_id] = kept
+                index['conversations'][conv_id] = next(conv for conv in remaining if conv['id'] == conv_id)
+        
+        # 会話数が変わりIDFも変わるため、ノルムは次の類似検索で計算し直す
+        index['norms_dirty'] = True
+        
+        # 補完やあいまい検索に削除済みの語が出ないよう、ポスティングリストからもすぐに外す
+        unindex_messages(index, garden['messages'], garden['tombstones'] - tombstones_before)
+        
+        deleted_conversations = len(garden['conversations']) - len(remaining)
+        garden['conversations'] = remaining
+        index['suggest_cache'] = {}
+        
+        # 全会話が削除されたアップロードは再アップロードできるようにする
+        live_batches = {conv.get('batch_id') for conv in remaining}
+        garden['upload_hashes'] = {
+            digest: batch for digest, batch in garden['upload_hashes'].items() if batch in live_batches
+        }
+        garden['generation'] += 1
+        
+        garden['stats']['messages'] = len(garden['messages']) - len(garden['tombstones'])
+        garden['stats']['conversations'] = len(garden['conversations'])
+    
+    schedule_compaction(garden)
+    return deleted_messages, deleted_conversations
+
+def schedule_compaction(garden):
+    """削除済みメッセージが閾値を超えたらバックグラウンドで圧縮"""
+    with garden['lock']:
+        tombstones = len(garden['tombstones'])
+        if garden['compacting'] or not tombstones:
+            return
+        if tombstones < COMPACTION_MAX_TOMBSTONES and tombstones < len(garden['messages']) * COMPACTION_RATIO:
+            return
+        garden['compacting'] = True
+    threading.Thread(target=compact_garden, args=(garden,), daemon=True).start()
+
+def compact_garden(garden):
+    """削除済みメッセージを取り除き、インデックスを作り直す"""
+    try:
+        for _ in range(COMPACTION_MAX_ATTEMPTS):
+            with garden['lock']:
+                generation = garden['generation']
+                messages = [message for _, message in live_messages(garden)]
+                conversations = list(garden['conversations'])
+            
+            # 再構築はロックの外で行い、検索やアップロードを止めない
+            rebuilt = {'messages': messages, 'index': None}
+            index_messages(rebuilt)
+            index_conversations(rebuilt, conversations)
+            
+            with garden['lock']:
+                if garden['generation'] != generation:
+                    continue
+                garden['messages'] = messages
+                garden['index'] = rebuilt['index']
+                garden['tombstones'] = set()
+                garden['generation'] += 1
+                garden['size'] = estimate_size(messages)
+                print(f"圧縮完了: {len(messages)}メッセージ")
+                return
+    except Exception as e:
+        print(f"圧縮エラー: {e}")
+    finally:
+        with garden['lock']:
+            garden['compacting'] = False
+
+def estimate_size(messages):
+    """メッセージが使用するメモリ量を推定"""
+    return sum(
+        len(message['content']) * GARDEN_BYTES_PER_CHAR + GARDEN_BYTES_PER_MESSAGE
+        for message in messages
+    )
+
+def garden_key():
+    """リクエストに対応するガーデンのキーを取得（ヘッダー優先、なければセッション）"""
+    key = request.headers.get('X-Garden-Key')
+    if key and GARDEN_KEY_PATTERN.match(key):
+        return key
+    if not GARDEN_KEY_PATTERN.match(session.get('garden_id', '')):
+        session['garden_id'] = uuid.uuid4().hex
+    return session['garden_id']
+
+def snapshot_path(key):
+    """ガーデンのスナップショットファイルのパス"""
+    return os.path.join(GARDEN_SNAPSHOT_DIR, f"{key}.json")
+
+def prepare_snapshot_dir():
+    """スナップショットの保存先を作成し、このプロセスのユーザー専用であることを確認"""
+    os.makedirs(GARDEN_SNAPSHOT_DIR, mode=0o700, exist_ok=True)
+    if os.path.islink(GARDEN_SNAPSHOT_DIR):
+        raise PermissionError(f"スナップショットの保存先がシンボリックリンクです: {GARDEN_SNAPSHOT_DIR}")
+    info = os.stat(GARDEN_SNAPSHOT_DIR)
+    if hasattr(os, 'getuid') and info.st_uid != os.getuid():
+        raise PermissionError(f"スナップショットの保存先が他のユーザーの所有です: {GARDEN_SNAPSHOT_DIR}")
+    if info.st_mode & 0o077:
+        os.chmod(GARDEN_SNAPSHOT_DIR, 0o700)
+
+def current_garden():
+    """現在のリクエストのガーデンを取得（退避済みならディスクから読み込む）"""
+    key = garden_key()
+    while True:
+        with gardens_lock:
+            garden = gardens.get(key)
+            if garden is None and key in evicting_gardens:
+                # 退避中に再び使われた場合はメモリ上のデータを使い、書き込みは破棄させる
+                garden = evicting_gardens.pop(key)
+            if garden is not None:
+                gardens[key] = garden
+                gardens.move_to_end(key)
+                garden['active'] += 1
+                break
+            loading = loading_gardens.get(key)
+            is_loader = loading is None
+            if is_loader:
+                loading = loading_gardens[key] = threading.Event()
+        
+        if not is_loader:
+            # 他のリクエストが読み込み中なら完了を待つ
+            loading.wait()
+            continue
+        
+        # スナップショットの読み込みはロックの外で行い、他のガーデンへのリクエストを止めない
+        loaded = None
+        try:
+            loaded = load_garden(key)
+        finally:
+            with gardens_lock:
+                if loaded is not None:
+                    gardens[key] = loaded
+                loading_gardens.pop(key).set()
+    
+    g.garden = garden
+    g.garden_key = key
+    enforce_memory_budget()
+    return garden
+
+@knowledge_bp.teardown_request
+def release_garden(exc):
+    """リクエスト終了時にガーデンを処理中の状態から外す"""
+    garden = g.pop('garden', None)
+    if garden is not None:
+        with gardens_lock:
+            garden['active'] -= 1
+            # 空のガーデンは保持しない
+            if not garden['active'] and not garden['messages'] and gardens.get(g.garden_key) is garden:
+                del gardens[g.garden_key]
+
+def load_garden(key):
+    """スナップショットからガーデンを読み込む（なければ新規作成）"""
+    path = snapshot_path(key)
+    if not os.path.exists(path):
+        return new_garden()
+    try:
+        prepare_snapshot_dir()
+        with open(path, 'r', encoding='utf-8') as f:
+            snapshot = json.load(f)
+        os.remove(path)
+        # スナップショットはデータのみ保持するため、インデックスは読み込み時に作り直す
+        garden = new_garden()
+        garden['messages'] = snapshot['messages']
+        garden['conversations'] = snapshot['conversations']
+        garden['stats'] = snapshot['stats']
+        garden['upload_hashes'] = snapshot['upload_hashes']
+        garden['size'] = estimate_size(garden['messages'])
+        index_messages(garden)
+        index_conversations(garden, garden['conversations'])
+        print(f"ガーデン読み込み: {key}")
+        return garden
+    except Exception as e:
+        print(f"ガーデン読み込みエラー: {e}")
+        return new_garden()
+
+def enforce_memory_budget():
+    """メモリ予算を超えたら、使われていないガーデンを古い順にディスクへ退避"""
+    while True:
+        with gardens_lock:
+            if sum(garden['size'] for garden in gardens.values()) <= GARDEN_MEMORY_BUDGET:
+                return
+            victim = next(
+                (key for key, garden in gardens.items()
+                 if not garden['active'] and not garden['compacting']),
+                None
+            )
+            if victim is None:
+                return
+            garden = gardens.pop(victim)
+            evicting_gardens[victim] = garden
+        
+        path = snapshot_path(victim)
+        temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        try:
+            prepare_snapshot_dir()
+            # 読み込み時にコードが実行されないよう、削除済みを除いたデータだけをJSONで保存する
+            with garden['lock']:
+                data = json.dumps({
+                    'messages': [message for _, message in live_messages(garden)],
+                    'conversations': garden['conversations'],
+                    'stats': garden['stats'],
+                    'upload_hashes': garden['upload_hashes']
+                }, ensure_ascii=False)
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                f.write(data)
+        except Exception as e:
+            print(f"ガーデン退避エラー: {e}")
+            with gardens_lock:
+                if evicting_gardens.pop(victim, None) is garden:
+                    gardens.setdefault(victim, garden)
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            return
+        
+        # 書き込み中に再び使われた場合はメモリ上のデータが正しいため、スナップショットを破棄する
+        with gardens_lock:
+            if evicting_gardens.get(victim) is garden:
+                os.replace(temp_path, path)
+                del evicting_gardens[victim]
+                print(f"ガーデン退避: {victim}")
+            else:
+                os.remove(temp_path)
+
+def term_weight(count):
+    """出現回数を対数スケールの重みに変換"""
+    return 1 + math.log(count)
+
+def term_idf(index, term):
+    """語の逆文書頻度（平滑化あり）"""
+    total = len(index['conv_terms'])
+    return math.log((1 + total) / (1 + len(index['conv_postings'].get(term, ())))) + 1
+
+def similar_conversations(index, term_counts, limit=SIMILAR_DEFAULT_LIMIT, exclude=None):
+    """語の出現回数に対してコサイン類似度が高い会話を上位から取得"""
+    if index['norms_dirty']:
+        refresh_norms(index)
+    
+    max_df = max(SIMILAR_MIN_DF_CUTOFF, len(index['conv_terms']) * SIMILAR_MAX_DF_RATIO)
+    weights = {}
+    for term, count in term_counts.items():
+        if term in index['conv_postings'] and len(index['conv_postings'][term]) <= max_df:
+            idf = term_idf(index, term)
+            weights[term] = (term_weight(count) * idf, idf)
+    # 重みの大きい語だけを使って、走査するポスティングの量を抑える
+    top_terms = heapq.nlargest(SIMILAR_QUERY_TERMS, weights.items(), key=lambda item: item[1][0])
+    query_norm = math.sqrt(sum(weight ** 2 for _, (weight, _) in top_terms))
+    if not query_norm:
+        return []
+    
+    scores = {}
+    for term, (weight, idf) in top_terms:
+        factor = weight * idf
+        for conv_id, tf_weight in index['conv_postings'][term].items():
+            scores[conv_id] = scores.get(conv_id, 0.0) + factor * tf_weight
+    scores.pop(exclude, None)
+    
+    best = heapq.nlargest(
+        limit,
+        ((score / (query_norm * index['conv_norms'][conv_id]), conv_id)
+         for conv_id, score in scores.items() if index['conv_norms'].get(conv_id)),
+    )
+    # ノルムが現在のIDFと一致していればコサイン類似度は1を超えない（丸め誤差のみ補正）
+    return [(conv_id, round(min(score, 1.0), 4)) for score, conv_id in best]
+
+def related_results(index, ranked, service_filter='all'):
+    """類似会話の一覧をレスポンス形式に変換"""
+    results = []
+    for conv_id, score in ranked:
+        conv = index['conversations'].get(conv_id)
+        if conv is None:
+            continue
+        if service_filter != 'all' and conv['service'] != service_filter:
+            continue
+        result = conv.copy()
+        result['score'] = score
+        results.append(result)
+    return results
+
+def suggest_terms(index, prefix, limit=SUGGEST_DEFAULT_LIMIT):
+    """接頭辞に一致する語を出現メッセージ数の多い順に取得"""
+    cache_key = (prefix, limit)
+    if cache_key in index['suggest_cache']:
+        return index['suggest_cache'][cache_key]
+    
+    if index['sorted_terms'] is None:
+        index['sorted_terms'] = sorted(index['postings'])
+    terms = index['sorted_terms']
+    
+    # 辞書順の一覧から接頭辞に一致する範囲を二分探索で特定
+    lo = bisect.bisect_left(terms, prefix)
+    hi = bisect.bisect_left(terms, prefix + '\U0010ffff', lo)
+    best = heapq.nlargest(limit, terms[lo:hi], key=lambda term: len(index['postings'][term]))
+    suggestions = [{'term': term, 'count': len(index['postings'][term])} for term in best]
+    
+    if len(index['suggest_cache']) >= SUGGEST_CACHE_SIZE:
+        index['suggest_cache'].clear()
+    index['suggest_cache'][cache_key] = suggestions
+    return suggestions
+
+def edit_distance(a, b):
+    """隣接文字の入れ替えを考慮した編集距離"""
+    previous2 = None
+    previous = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], previous2[j - 2] + 1)
+        previous2, previous = previous, current
+    return previous[len(b)]
+
+def expand_fuzzy_term(index, term):
+    """誤字や入力途中の語を、インデックス中の近い語に展開
+    
+    その語で始まる語（語自体を含む）があれば前方一致で展開し、
+    なければ編集距離の近い語に展開する。
+    """
+    prefixed = [suggestion['term'] for suggestion in suggest_terms(index, term, FUZZY_PREFIX_LIMIT)]
+    if prefixed:
+        return prefixed
+    if len(term) < FUZZY_MIN_TERM_LENGTH:
+        return []
+    
+    max_distance = 1 if len(term) <= 5 else 2
+    grams = term_trigrams(term)
+    shared = Counter()
+    
+    # 出現する語の少ないトライグラムから順にたどり、たどる語の総数を制限する
+    scanned = 0
+    for gram in sorted(grams, key=lambda gram: len(index['trigrams'].get(gram, ()))):
+        candidates = index['trigrams'].get(gram, ())
+        scanned += len(candidates)
+        if scanned > FUZZY_TRIGRAM_SCAN_LIMIT:
+            break
+        for candidate in candidates:
+            if abs(len(candidate) - len(term)) <= max_distance:
+                shared[candidate] += 1
+    
+    # Jaccard係数の高い順に候補を絞り込んでから編集距離を計算
+    ranked = sorted(
+        shared.items(),
+        key=lambda item: item[1] / (len(grams) + len(item[0]) - item[1]),
+        reverse=True
+    )
+    scored = []
+    for candidate, _ in ranked[:FUZZY_CANDIDATE_LIMIT]:
+        distance = edit_distance(term, candidate)
+        if distance <= max_distance:
+            scored.append((distance, -len(index['postings'][candidate]), candidate))
+    scored.sort()
+    return [candidate for _, _, candidate in scored[:FUZZY_MAX_EXPANSIONS]]
+
+def fuzzy_lookup(garden, query):
+    """あいまい検索: 各クエリ語を展開し、ポスティングリストの積集合を取得"""
+    index = garden['index'] or new_search_index()
+    expansions = {}
+    positions = None
+    for term in dict.fromkeys(tokenize(query)):
+        expanded = expand_fuzzy_term(index, term)
+        expansions[term] = expanded
+        matched = set()
+        for candidate in expanded:
+            matched |= index['postings'][candidate]
+        positions = matched if positions is None else positions & matched
+        if not positions:
+            break
+    return sorted(positions or ()), expansions
+
+def progress_reporter(progress_key):
+    """アップロードの進捗を記録する関数を作成"""
+    # 古い進捗を削除
+    now = time.time()
+    for key, entry in list(upload_progress.items()):
+        if entry['state'] in PROGRESS_FINAL_STATES and now - entry['updated'] > PROGRESS_RETENTION_SECONDS:
+            upload_progress.pop(key, None)
+    
+    entry = {
+        'state': 'received',
+        'conversations': 0,
+        'messages': 0,
+        'indexed': 0,
+        'updated': now
+    }
+    upload_progress[progress_key] = entry
+    
+    def report(**fields):
+        entry.update(fields)
+        entry['updated'] = time.time()
+    return report
 
 def detect_service_type(data):
     """ファイルの内容からAIサービスの種類を判定"""
@@ -49,8 +673,71 @@ def detect_service_type(data):
         print(f"サービス判定エラー: {e}")
         return 'unknown'
 
-def parse_chatgpt_data(data):
-    """ChatGPTのエクスポートデータを解析"""
+def chatgpt_thread(mapping, current_node=None, include_branches=False):
+    """mappingの親子関係をたどり、ノードIDを会話の順に並べる
+    
+    現在の末端（current_node）から根までの経路を本筋とし、include_branchesが
+    真の場合は編集などで分岐した残りのノードを分岐として末尾に加える。
+    戻り値は (ノードID, 分岐かどうか) の一覧。
+    """
+    roots = [node_id for node_id, node in mapping.items() if node.get('parent') not in mapping]
+    has_links = any(node.get('parent') or node.get('children') for node in mapping.values())
+    if not has_links or not roots:
+        # 親子関係がない形式はmappingの順序のまま
+        return [(node_id, False) for node_id in mapping]
+    
+    def children_of(node_id):
+        return [child for child in mapping[node_id].get('children') or [] if child in mapping]
+    
+    # 末端が指定されていなければ、根から最新の分岐（最後の子）をたどる
+    if current_node not in mapping:
+        current_node = roots[0]
+        visited = {current_node}
+        while True:
+            children = children_of(current_node)
+            if not children or children[-1] in visited:
+                break
+            current_node = children[-1]
+            visited.add(current_node)
+    
+    # 末端から根まで親をたどって本筋を作る
+    path = []
+    on_path = set()
+    node_id = current_node
+    while node_id in mapping and node_id not in on_path:
+        on_path.add(node_id)
+        path.append(node_id)
+        node_id = mapping[node_id].get('parent')
+    path.reverse()
+    thread = [(node_id, False) for node_id in path]
+    
+    if include_branches:
+        # 本筋以外のノードを根から深さ優先でたどる
+        visited = set()
+        stack = list(reversed(roots))
+        while stack:
+            node_id = stack.pop()
+            if node_id in visited:
+                continue
+            visited.add(node_id)
+            if node_id not in on_path:
+                thread.append((node_id, True))
+            stack.extend(reversed(children_of(node_id)))
+    
+    return thread
+
+def thread_positions(conv_messages):
+    """会話内の位置を付与し、最初のユーザー・アシスタント発言の位置を取得"""
+    first_positions = {'first_user_position': None, 'first_assistant_position': None}
+    for position, msg in enumerate(conv_messages):
+        msg['position'] = position
+        key = f"first_{msg['role']}_position"
+        if key in first_positions and first_positions[key] is None and not msg.get('branch'):
+            first_positions[key] = position
+    return first_positions
+
+def parse_chatgpt_data(data, progress=None, include_branches=False):
+    """ChatGPTのエクスポートデータを解析（メッセージは会話の流れの順に並べる）"""
     messages = []
     conversations = []
     
@@ -67,8 +754,9 @@ def parse_chatgpt_data(data):
             mapping = conversation.get('mapping', {})
             conv_messages = []
             
-            for node_id, node in mapping.items():
-                message = node.get('message')
+            thread = chatgpt_thread(mapping, conversation.get('current_node'), include_branches)
+            for node_id, is_branch in thread:
+                message = mapping[node_id].get('message')
                 if not message or not message.get('content'):
                     continue
                     
@@ -88,6 +776,8 @@ def parse_chatgpt_data(data):
                         'conversation_title': title,
                         'service': 'ChatGPT'
                     }
+                    if is_branch:
+                        msg['branch'] = True
                     messages.append(msg)
                     conv_messages.append(msg)
             
@@ -97,14 +787,17 @@ def parse_chatgpt_data(data):
                     'title': title,
                     'create_time': create_time,
                     'message_count': len(conv_messages),
-                    'service': 'ChatGPT'
+                    'service': 'ChatGPT',
+                    **thread_positions(conv_messages)
                 })
+                if progress and len(conversations) % PROGRESS_INTERVAL == 0:
+                    progress(conversations=len(conversations), messages=len(messages))
     except Exception as e:
         print(f"ChatGPT解析エラー: {e}")
     
     return messages, conversations
 
-def parse_text_format(text_data, service_name, user_prefix, assistant_prefix):
+def parse_text_format(text_data, service_name, user_prefix, assistant_prefix, progress=None):
     """テキスト形式のデータを解析（汎用）"""
     messages = []
     conversations = []
@@ -118,7 +811,10 @@ def parse_text_format(text_data, service_name, user_prefix, assistant_prefix):
         conv_id = f"{service_name.lower()}_conv_{datetime.now().timestamp()}"
         title = f"{service_name} Conversation"
         
-        for line in lines:
+        for line_number, line in enumerate(lines, 1):
+            if progress and line_number % PROGRESS_INTERVAL == 0:
+                progress(messages=len(messages))
+            
             line = line.strip()
             if not line:
                 continue
@@ -186,14 +882,15 @@ def parse_text_format(text_data, service_name, user_prefix, assistant_prefix):
                 'title': title,
                 'create_time': datetime.now().timestamp(),
                 'message_count': len(messages),
-                'service': service_name
+                'service': service_name,
+                **thread_positions(messages)
             })
     except Exception as e:
         print(f"{service_name}解析エラー: {e}")
     
     return messages, conversations
 
-def parse_openai_api_format(data):
+def parse_openai_api_format(data, progress=None):
     """OpenAI API形式のデータを解析"""
     messages = []
     conversations = []
@@ -213,6 +910,8 @@ def parse_openai_api_format(data):
                     'service': 'OpenAI API'
                 }
                 messages.append(message)
+                if progress and len(messages) % PROGRESS_INTERVAL == 0:
+                    progress(messages=len(messages))
         
         if messages:
             conversations.append({
@@ -220,7 +919,8 @@ def parse_openai_api_format(data):
                 'title': title,
                 'create_time': datetime.now().timestamp(),
                 'message_count': len(messages),
-                'service': 'OpenAI API'
+                'service': 'OpenAI API',
+                **thread_positions(messages)
             })
     except Exception as e:
         print(f"OpenAI API解析エラー: {e}")
@@ -230,20 +930,56 @@ def parse_openai_api_format(data):
 @knowledge_bp.route('/upload', methods=['POST'])
 def upload_file():
     """複数のAIサービスのログファイルをアップロード"""
+    report = None
+    digest = None
     try:
+        chat_data = current_garden()
+        
+        # 進捗はクライアントが指定したアップロードIDで /api/upload/progress/<ID> から取得できる
+        # （IDはガーデンごとに区別するため、他のユーザーの進捗は見えない）
+        upload_id = request.form.get('upload_id', '')
+        if not UPLOAD_ID_PATTERN.match(upload_id):
+            upload_id = uuid.uuid4().hex
+        progress_key = (g.garden_key, upload_id)
+        if upload_progress.get(progress_key, {}).get('state', 'done') not in PROGRESS_FINAL_STATES:
+            return jsonify({'error': 'このアップロードは処理中です'}), 409
+        report = progress_reporter(progress_key)
+        
+        def upload_error(message, status):
+            report(state='error', error=message)
+            return jsonify({'error': message, 'upload_id': upload_id}), status
+        
         if 'file' not in request.files:
-            return jsonify({'error': 'ファイルが選択されていません'}), 400
+            return upload_error('ファイルが選択されていません', 400)
         
         file = request.files['file']
         if file.filename == '':
-            return jsonify({'error': 'ファイルが選択されていません'}), 400
+            return upload_error('ファイルが選択されていません', 400)
         
         # ファイル内容を読み取り
         try:
             file_content = file.read()
             print(f"ファイルサイズ: {len(file_content)} bytes")
         except Exception as e:
-            return jsonify({'error': f'ファイル読み取りエラー: {str(e)}'}), 400
+            return upload_error(f'ファイル読み取りエラー: {str(e)}', 400)
+        
+        # 同じ内容のファイルが取り込み済み・処理中なら重複として扱う
+        digest = hashlib.sha256(file_content).hexdigest()
+        with chat_data['lock']:
+            existing_batch = chat_data['upload_hashes'].get(digest)
+            duplicate = existing_batch is not None or digest in chat_data['pending_uploads']
+            if not duplicate:
+                chat_data['pending_uploads'].add(digest)
+        if duplicate:
+            digest = None
+            report(state='duplicate')
+            return jsonify({
+                'error': 'このファイルは既にアップロードされています',
+                'upload_id': upload_id,
+                'batch_id': existing_batch
+            }), 409
+        
+        report(state='parsing')
         
         # データの解析を試行
         data = None
@@ -261,10 +997,10 @@ def upload_file():
                     data = file_content.decode('utf-8', errors='ignore')
                     print("テキストファイルとして解析成功（エラー無視）")
                 except Exception as e:
-                    return jsonify({'error': f'ファイルの文字エンコーディングが不正です: {str(e)}'}), 400
+                    return upload_error(f'ファイルの文字エンコーディングが不正です: {str(e)}', 400)
         
         if data is None:
-            return jsonify({'error': 'ファイルの内容を読み取れませんでした'}), 400
+            return upload_error('ファイルの内容を読み取れませんでした', 400)
         
         # サービスタイプを判定
         service_type = detect_service_type(data)
@@ -275,67 +1011,184 @@ def upload_file():
         conversations = []
         
         if service_type == 'chatgpt':
-            messages, conversations = parse_chatgpt_data(data)
+            include_branches = request.form.get('include_branches', 'false').lower() == 'true'
+            messages, conversations = parse_chatgpt_data(data, report, include_branches)
         elif service_type == 'claude_text':
-            messages, conversations = parse_text_format(data, 'Claude', 'Human:', 'Assistant:')
+            messages, conversations = parse_text_format(data, 'Claude', 'Human:', 'Assistant:', report)
         elif service_type == 'gemini_text':
-            messages, conversations = parse_text_format(data, 'Gemini', 'User:', 'Gemini:')
+            messages, conversations = parse_text_format(data, 'Gemini', 'User:', 'Gemini:', report)
         elif service_type == 'grok_text':
-            messages, conversations = parse_text_format(data, 'Grok', 'You:', 'Grok:')
+            messages, conversations = parse_text_format(data, 'Grok', 'You:', 'Grok:', report)
         elif service_type == 'openai_api':
-            messages, conversations = parse_openai_api_format(data)
+            messages, conversations = parse_openai_api_format(data, report)
         elif service_type == 'generic_chat':
             # 汎用チャット形式として処理
-            messages, conversations = parse_text_format(data, 'Generic Chat', 'User:', 'Assistant:')
+            messages, conversations = parse_text_format(data, 'Generic Chat', 'User:', 'Assistant:', report)
         else:
             # 不明な形式でも基本的な処理を試行
             if isinstance(data, str) and len(data.strip()) > 0:
-                messages, conversations = parse_text_format(data, 'Unknown Service', 'User:', 'Assistant:')
+                messages, conversations = parse_text_format(data, 'Unknown Service', 'User:', 'Assistant:', report)
             else:
-                return jsonify({'error': f'サポートされていないファイル形式です。検出されたタイプ: {service_type}'}), 400
+                return upload_error(f'サポートされていないファイル形式です。検出されたタイプ: {service_type}', 400)
         
         if not messages:
-            return jsonify({'error': 'ファイルからメッセージを抽出できませんでした。ファイル形式を確認してください。'}), 400
+            return upload_error('ファイルからメッセージを抽出できませんでした。ファイル形式を確認してください。', 400)
+        
+        report(state='indexing', conversations=len(conversations), messages=len(messages))
+        
+        # アップロード単位で削除できるようにバッチIDを付与
+        batch_id = uuid.uuid4().hex
+        for item in messages + conversations:
+            item['batch_id'] = batch_id
         
         # データを統合
-        chat_data['messages'].extend(messages)
-        chat_data['conversations'].extend(conversations)
+        with chat_data['lock']:
+            start = len(chat_data['messages'])
+            chat_data['messages'].extend(messages)
+            chat_data['conversations'].extend(conversations)
+            index_messages(chat_data, start, report)
+            index_conversations(chat_data, conversations)
+            chat_data['generation'] += 1
+            chat_data['size'] += estimate_size(messages)
+            chat_data['upload_hashes'][digest] = batch_id
+            
+            # 統計を更新
+            chat_data['stats']['messages'] = len(chat_data['messages']) - len(chat_data['tombstones'])
+            chat_data['stats']['conversations'] = len(chat_data['conversations'])
         
-        # 統計を更新
-        chat_data['stats']['messages'] = len(chat_data['messages'])
-        chat_data['stats']['conversations'] = len(chat_data['conversations'])
+        # 他のガーデンを退避してメモリ予算内に収める
+        enforce_memory_budget()
         
         print(f"処理完了: {len(messages)}メッセージ, {len(conversations)}会話")
+        report(state='done', indexed=len(messages), batch_id=batch_id)
         
         return jsonify({
             'success': True,
             'message': f'{len(messages)}個のメッセージが正常に処理されました',
             'service_type': service_type,
+            'upload_id': upload_id,
+            'batch_id': batch_id,
             'stats': chat_data['stats']
         })
         
     except Exception as e:
         print(f"アップロードエラー: {str(e)}")
+        if report:
+            report(state='error', error=str(e))
         return jsonify({'error': f'ファイル処理中にエラーが発生しました: {str(e)}'}), 500
+    finally:
+        if digest:
+            with chat_data['lock']:
+                chat_data['pending_uploads'].discard(digest)
+
+@knowledge_bp.route('/upload/progress/<upload_id>', methods=['GET'])
+def upload_progress_events(upload_id):
+    """アップロードの進捗をServer-Sent Eventsで配信"""
+    # ジェネレーターはリクエスト終了後に動くため、キーは先に決めておく
+    progress_key = (garden_key(), upload_id)
+    
+    def events():
+        waited = 0.0
+        last_update = None
+        while True:
+            entry = upload_progress.get(progress_key)
+            if entry is None:
+                # アップロードの開始前に接続された場合は開始を待つ
+                if waited >= PROGRESS_WAIT_SECONDS:
+                    yield f"data: {json.dumps({'state': 'unknown'})}\n\n"
+                    return
+            elif entry['updated'] != last_update:
+                last_update = entry['updated']
+                snapshot = {key: value for key, value in entry.items() if key != 'updated'}
+                yield f"data: {json.dumps(snapshot, ensure_ascii=False)}\n\n"
+                if entry['state'] in PROGRESS_FINAL_STATES:
+                    return
+            time.sleep(PROGRESS_POLL_SECONDS)
+            waited += PROGRESS_POLL_SECONDS
+    
+    return Response(events(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+@knowledge_bp.route('/suggest', methods=['GET'])
+def suggest():
+    """入力途中の語の補完候補を取得"""
+    try:
+        chat_data = current_garden()
+        tokens = tokenize(request.args.get('prefix', ''))
+        if not tokens or chat_data['index'] is None:
+            return jsonify({'suggestions': [], 'prefix': ''})
+        
+        # 最後の語を補完対象とする
+        prefix = tokens[-1]
+        limit = request.args.get('limit', SUGGEST_DEFAULT_LIMIT, type=int)
+        
+        with chat_data['lock']:
+            suggestions = suggest_terms(chat_data['index'], prefix, limit)
+        
+        return jsonify({
+            'suggestions': suggestions,
+            'prefix': prefix
+        })
+        
+    except Exception as e:
+        print(f"補完候補取得エラー: {str(e)}")
+        return jsonify({'error': f'補完候補取得中にエラーが発生しました: {str(e)}'}), 500
 
 @knowledge_bp.route('/search', methods=['POST'])
 def search_messages():
     """統合されたメッセージを検索"""
     try:
+        chat_data = current_garden()
         data = request.get_json()
         query = data.get('query', '').lower()
         date_filter = data.get('date_filter', 'all')
         speaker_filter = data.get('speaker_filter', 'all')
         service_filter = data.get('service_filter', 'all')
+        mode = data.get('mode', 'substring')
         
         if not query:
             return jsonify({'results': [], 'total': 0})
         
+        # 類似会話検索: クエリをTF-IDFベクトルとして会話と比較
+        if mode == 'similar':
+            try:
+                limit = int(data.get('limit', SIMILAR_DEFAULT_LIMIT))
+            except (TypeError, ValueError):
+                limit = SIMILAR_DEFAULT_LIMIT
+            with chat_data['lock']:
+                index = chat_data['index'] or new_search_index()
+                ranked = similar_conversations(index, Counter(tokenize(query)), limit)
+                results = related_results(index, ranked, service_filter)
+            chat_data['stats']['searches'] += 1
+            return jsonify({
+                'results': results,
+                'total': len(results),
+                'query': query,
+                'mode': mode,
+                'stats': chat_data['stats']
+            })
+        
+        # 検索対象の絞り込み
+        expansions = None
+        if mode == 'fuzzy':
+            # あいまい検索: インデックスから候補メッセージを取得
+            with chat_data['lock']:
+                positions, expansions = fuzzy_lookup(chat_data, query)
+                messages, _, tombstones = garden_snapshot(chat_data)
+                candidates = [messages[position] for position in positions if position not in tombstones]
+            terms = sorted({term for expanded in expansions.values() for term in expanded}, key=len, reverse=True)
+            highlight_pattern = '|'.join(re.escape(term) for term in terms)
+        else:
+            candidates = (message for _, message in live_messages(chat_data))
+            highlight_pattern = re.escape(query)
+        
         # 検索実行
         results = []
-        for message in chat_data['messages']:
+        for message in candidates:
             # テキスト検索
-            if query not in message['content'].lower():
+            if mode != 'fuzzy' and query not in message['content'].lower():
                 continue
             
             # 話者フィルター
@@ -348,11 +1201,11 @@ def search_messages():
             
             # ハイライト処理
             highlighted_content = re.sub(
-                f'({re.escape(query)})',
+                f'({highlight_pattern})',
                 r'<mark>\1</mark>',
                 message['content'],
                 flags=re.IGNORECASE
-            )
+            ) if highlight_pattern else message['content']
             
             result = message.copy()
             result['highlighted_content'] = highlighted_content
@@ -361,12 +1214,17 @@ def search_messages():
         # 検索回数を更新
         chat_data['stats']['searches'] += 1
         
-        return jsonify({
+        response = {
             'results': results,
             'total': len(results),
             'query': query,
+            'mode': mode,
             'stats': chat_data['stats']
-        })
+        }
+        if expansions is not None:
+            response['expanded_terms'] = expansions
+        
+        return jsonify(response)
         
     except Exception as e:
         print(f"検索エラー: {str(e)}")
@@ -376,6 +1234,7 @@ def search_messages():
 def get_recent_chats():
     """最近のチャット概要を取得（サービス別）"""
     try:
+        chat_data = current_garden()
         # 会話を作成時間順にソート
         sorted_conversations = sorted(
             chat_data['conversations'],
@@ -384,17 +1243,17 @@ def get_recent_chats():
         )
         
         # 各会話の最初のメッセージを取得
+        messages, index, _ = garden_snapshot(chat_data)
         summaries = []
         for conv in sorted_conversations[:10]:  # 最新10件
-            conv_messages = [
-                msg for msg in chat_data['messages']
-                if msg['conversation_id'] == conv['id']
-            ]
+            positions = index['conv_messages'].get(conv['id'], [])
             
-            if conv_messages:
-                # 最初のユーザーメッセージとアシスタントメッセージを取得
-                user_msg = next((msg for msg in conv_messages if msg['role'] == 'user'), None)
-                assistant_msg = next((msg for msg in conv_messages if msg['role'] == 'assistant'), None)
+            if positions:
+                # 取り込み時に求めた位置から最初のユーザーメッセージとアシスタントメッセージを取得
+                user_position = conv.get('first_user_position')
+                assistant_position = conv.get('first_assistant_position')
+                user_msg = messages[positions[user_position]] if user_position is not None else None
+                assistant_msg = messages[positions[assistant_position]] if assistant_position is not None else None
                 
                 summary = {
                     'conversation_id': conv['id'],
@@ -416,13 +1275,102 @@ def get_recent_chats():
         print(f"チャット概要取得エラー: {str(e)}")
         return jsonify({'error': f'チャット概要取得中にエラーが発生しました: {str(e)}'}), 500
 
+@knowledge_bp.route('/conversations/<conv_id>', methods=['GET'])
+def get_conversation(conv_id):
+    """会話のメッセージを会話の流れの順に取得"""
+    try:
+        chat_data = current_garden()
+        all_messages, index, _ = garden_snapshot(chat_data)
+        positions = index['conv_messages'].get(conv_id)
+        if positions is None:
+            return jsonify({'error': '会話が見つかりません'}), 404
+        
+        # メッセージは取り込み時に会話順に並べてあるため、範囲を切り出すだけでよい
+        offset = max(request.args.get('offset', 0, type=int), 0)
+        limit = request.args.get('limit', len(positions), type=int)
+        messages = [all_messages[position] for position in positions[offset:offset + limit]]
+        
+        return jsonify({
+            'conversation': index['conversations'].get(conv_id),
+            'messages': messages,
+            'total': len(positions)
+        })
+        
+    except Exception as e:
+        print(f"会話取得エラー: {str(e)}")
+        return jsonify({'error': f'会話取得中にエラーが発生しました: {str(e)}'}), 500
+
+@knowledge_bp.route('/conversations/<conv_id>/related', methods=['GET'])
+def get_related_conversations(conv_id):
+    """指定した会話に内容が近い会話を取得"""
+    try:
+        chat_data = current_garden()
+        limit = request.args.get('limit', SIMILAR_DEFAULT_LIMIT, type=int)
+        with chat_data['lock']:
+            index = chat_data['index'] or new_search_index()
+            if conv_id not in index['conv_terms']:
+                return jsonify({'error': '会話が見つかりません'}), 404
+            ranked = similar_conversations(index, index['conv_terms'][conv_id], limit, exclude=conv_id)
+            results = related_results(index, ranked)
+        
+        return jsonify({
+            'conversation_id': conv_id,
+            'results': results,
+            'total': len(results)
+        })
+        
+    except Exception as e:
+        print(f"関連会話取得エラー: {str(e)}")
+        return jsonify({'error': f'関連会話取得中にエラーが発生しました: {str(e)}'}), 500
+
+@knowledge_bp.route('/conversations/<conv_id>', methods=['DELETE'])
+def delete_conversation(conv_id):
+    """会話を削除"""
+    try:
+        chat_data = current_garden()
+        deleted_messages, deleted_conversations = delete_conversations(chat_data, [conv_id])
+        if not deleted_conversations:
+            return jsonify({'error': '会話が見つかりません'}), 404
+        
+        return jsonify({
+            'success': True,
+            'message': f'{deleted_messages}個のメッセージが削除されました',
+            'stats': chat_data['stats']
+        })
+        
+    except Exception as e:
+        print(f"会話削除エラー: {str(e)}")
+        return jsonify({'error': f'会話削除中にエラーが発生しました: {str(e)}'}), 500
+
+@knowledge_bp.route('/uploads/<batch_id>', methods=['DELETE'])
+def delete_upload(batch_id):
+    """アップロード単位でデータを削除"""
+    try:
+        chat_data = current_garden()
+        conv_ids = [conv['id'] for conv in chat_data['conversations'] if conv.get('batch_id') == batch_id]
+        if not conv_ids:
+            return jsonify({'error': 'アップロードが見つかりません'}), 404
+        
+        deleted_messages, deleted_conversations = delete_conversations(chat_data, conv_ids, batch_id)
+        
+        return jsonify({
+            'success': True,
+            'message': f'{deleted_conversations}個の会話（{deleted_messages}個のメッセージ）が削除されました',
+            'stats': chat_data['stats']
+        })
+        
+    except Exception as e:
+        print(f"アップロード削除エラー: {str(e)}")
+        return jsonify({'error': f'アップロード削除中にエラーが発生しました: {str(e)}'}), 500
+
 @knowledge_bp.route('/stats', methods=['GET'])
 def get_stats():
     """統計情報を取得"""
     try:
+        chat_data = current_garden()
         # サービス別統計を計算
         service_stats = {}
-        for msg in chat_data['messages']:
+        for _, msg in live_messages(chat_data):
             service = msg['service']
             if service not in service_stats:
                 service_stats[service] = {'messages': 0, 'conversations': 0}
@@ -461,9 +1409,16 @@ def get_supported_services():
 def clear_data():
     """データをクリア（デバッグ用）"""
     try:
-        chat_data['messages'] = []
-        chat_data['conversations'] = []
-        chat_data['stats'] = {'messages': 0, 'conversations': 0, 'searches': 0}
+        chat_data = current_garden()
+        with chat_data['lock']:
+            chat_data['messages'] = []
+            chat_data['conversations'] = []
+            chat_data['stats'] = {'messages': 0, 'conversations': 0, 'searches': 0}
+            chat_data['index'] = None
+            chat_data['tombstones'] = set()
+            chat_data['generation'] += 1
+            chat_data['size'] = 0
+            chat_data['upload_hashes'] = {}
         
         return jsonify({
             'success': True,
@@ -3,10 +3,19 @@ import sys
 # DON'T CHANGE THIS !!!
 sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
 
-from flask import Flask, send_from_directory, jsonify
+import gzip
+import hashlib
+import mimetypes
+import re
+from flask import Flask, Response, request, jsonify
 from flask_cors import CORS
 from src.routes.knowledge import knowledge_bp
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
 app = Flask(__name__, static_folder=os.path.join(os.path.dirname(__file__), 'static'))
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'asdf#FGSgvasgf$5$WGT')
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
@@ -17,23 +26,97 @@ CORS(app, origins="*")
 # ブループリント登録
 app.register_blueprint(knowledge_bp, url_prefix='/api')
 
+# 圧縮する価値のあるファイル形式
+COMPRESSIBLE_TYPES = ('text/', 'application/javascript', 'application/json', 'image/svg+xml')
+# HTML内の静的ファイル参照（バージョン付きURLに書き換える）
+ASSET_REFERENCE = re.compile(r'((?:href|src)=")([^"?#:]+)(")')
+
+def compress_variants(body, mimetype):
+    """gzip/brotli圧縮版を作成（元より小さくなる場合のみ）"""
+    variants = {'identity': body}
+    if not mimetype.startswith(COMPRESSIBLE_TYPES):
+        return variants
+    compressed = {'gzip': gzip.compress(body, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        compressed['br'] = brotli.compress(body)
+    for encoding, data in compressed.items():
+        if len(data) < len(body):
+            variants[encoding] = data
+    return variants
+
+def build_asset_manifest(static_folder_path):
+    """起動時に静的ファイルを読み込み、ETagと圧縮版をメモリに保持"""
+    files = {}
+    if static_folder_path is None or not os.path.isdir(static_folder_path):
+        return {}
+    for root, _, names in os.walk(static_folder_path):
+        for name in names:
+            full_path = os.path.join(root, name)
+            path = os.path.relpath(full_path, static_folder_path).replace(os.sep, '/')
+            with open(full_path, 'rb') as f:
+                files[path] = f.read()
+
+    def version(body):
+        return hashlib.sha256(body).hexdigest()[:16]
+
+    # HTMLから参照されるファイルをバージョン付きURLにして長期キャッシュ可能にする
+    for path, body in files.items():
+        if not path.endswith('.html'):
+            continue
+        html = body.decode('utf-8')
+        html = ASSET_REFERENCE.sub(
+            lambda m: f"{m.group(1)}{m.group(2)}?v={version(files[m.group(2)])}{m.group(3)}"
+            if m.group(2) in files and not m.group(2).endswith('.html') else m.group(0),
+            html
+        )
+        files[path] = html.encode('utf-8')
+
+    manifest = {}
+    for path, body in files.items():
+        mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        manifest[path] = {
+            'mimetype': mimetype,
+            'version': version(body),
+            'variants': compress_variants(body, mimetype)
+        }
+    return manifest
+
+asset_manifest = build_asset_manifest(app.static_folder)
+
 @app.route('/', defaults={'path': ''})
 @app.route('/<path:path>')
 def serve(path):
-    """静的ファイルとSPAルーティングを処理"""
-    static_folder_path = app.static_folder
-    if static_folder_path is None:
+    """静的ファイルとSPAルーティングを処理（メモリ上のマニフェストから配信）"""
+    if app.static_folder is None:
         return "Static folder not configured", 404
 
-    if path != "" and os.path.exists(os.path.join(static_folder_path, path)):
-        return send_from_directory(static_folder_path, path)
-    else:
-        index_path = os.path.join(static_folder_path, 'index.html')
-        if os.path.exists(index_path):
-            return send_from_directory(static_folder_path, 'index.html')
-        else:
+    asset = asset_manifest.get(path) if path != "" else None
+    if asset is None:
+        asset = asset_manifest.get('index.html')
+        if asset is None:
             return "index.html not found", 404
 
+    # Accept-Encodingに応じて圧縮版を選択
+    encoding = next(
+        (name for name in ('br', 'gzip') if name in asset['variants'] and request.accept_encodings[name] > 0),
+        'identity'
+    )
+    etag = f"{asset['version']}-{encoding}"
+
+    headers = {'ETag': f'"{etag}"', 'Vary': 'Accept-Encoding'}
+    # バージョン付きURLは内容が変わらないため長期キャッシュ
+    if request.args.get('v') == asset['version']:
+        headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    else:
+        headers['Cache-Control'] = 'no-cache'
+
+    if request.if_none_match.contains(etag):
+        return Response(status=304, headers=headers)
+
+    if encoding != 'identity':
+        headers['Content-Encoding'] = encoding
+    return Response(asset['variants'][encoding], mimetype=asset['mimetype'], headers=headers)
+
 @app.errorhandler(413)
 def too_large(e):
     """ファイルサイズが大きすぎる場合のエラーハンドリング"""